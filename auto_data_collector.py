@@ -1,23 +1,28 @@
 #!/usr/bin/env python3
 
 import datetime
-import sqlite3
-from canlib import canlib, CanlibException
-import time
-import struct
 import os
 import signal
 import sys
 import csv
-from database_functions import create_table_for_trial, store_data_for_trial, get_next_trial_number
-import queue
+from database_functions import (create_table_for_trial, store_data_for_trial, get_next_trial_number, open_db,
+                                quote_identifier, unpack_frames, FRAME_COLUMNS, EXPORT_MMAP_SIZE,
+                                WRITER_CACHE_SIZE)
+from can_functions import open_channel, read_can_messages, stop_event, CHANNEL
 import threading
+from collections import deque
+from contextlib import closing
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
 
 # Create necessary directories with proper permissions
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_DIR = os.path.join(BASE_DIR, "logs")
 CSV_DIR = os.path.join(BASE_DIR, "csv_data")
+CSV_BUFFER_SIZE = 1024 * 1024  # Write CSV exports in 1 MiB chunks
+FETCH_SIZE = 10000  # Rows read from the database per fetch when exporting
 
 # Create directories if they don't exist
 os.makedirs(LOG_DIR, exist_ok=True)
@@ -37,84 +42,142 @@ logging.basicConfig(
 FRAMES_DATABASE = os.path.join(BASE_DIR, "frames_data.db")
 
 # CAN configuration
-can_queue = queue.Queue()
-running = True
-POWER_THRESHOLD = 100
-POWER_OFF_THRESHOLD = 50
-POWER_CHECK_INTERVAL = 1.0
+can_queue = deque()  # Single producer and consumer, so no locking is needed
+data_ready = threading.Event()
+WRITE_BATCH_SIZE = 1000  # Queued rows that wake the writer early
+WRITE_INTERVAL = 0.25  # Maximum seconds between database writes
+
+# The export worker's database connection, opened on its first export and
+# kept for the life of the worker process
+export_conn = None
+
+def get_export_connection():
+    """Return this process's export connection, opening it on first use"""
+    global export_conn
+    if export_conn is None:
+        export_conn = open_db(FRAMES_DATABASE, mmap_size=EXPORT_MMAP_SIZE)
+    return export_conn
 
 def export_trial_to_csv(trial_number):
     """Export a trial's data to CSV"""
     try:
-        # Create CSV filename with timestamp
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        csv_filename = f"trial_{trial_number}_{timestamp}.csv"
-        csv_path = os.path.join(CSV_DIR, csv_filename)
-        
-        # Connect to database
-        conn = sqlite3.connect(FRAMES_DATABASE)
-        cursor = conn.cursor()
+        # Close the cursor after each export so the worker's long-lived
+        # connection holds no read snapshot between trials
+        with closing(get_export_connection().cursor()) as cursor:
+            cursor.arraysize = FETCH_SIZE
+            table_name = quote_identifier(trial_number)
         
-        # Get all data for this trial
-        cursor.execute(f"SELECT * FROM '{trial_number}'")
-        rows = cursor.fetchall()
+            # Trials that ended before any data arrived get no CSV
+            cursor.execute(f"SELECT 1 FROM {table_name} LIMIT 1")
+            if cursor.fetchone() is None:
+                logging.info(f"Trial {trial_number} has no data, skipping CSV export")
+                return
         
-        # Get column names
-        cursor.execute(f"PRAGMA table_info('{trial_number}')")
-        columns = [col[1] for col in cursor.fetchall()]
+            # Create CSV filename with timestamp
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            csv_filename = f"trial_{trial_number}_{timestamp}.csv"
+            csv_path = os.path.join(CSV_DIR, csv_filename)
         
-        # Write to CSV
-        with open(csv_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(columns)
-            writer.writerows(rows)
+            # Stream the trial's packed rows to CSV in chunks, one line per frame
+            cursor.execute(f"SELECT frames FROM {table_name} ORDER BY rowid")
+            with open(csv_path, 'w', newline='', buffering=CSV_BUFFER_SIZE) as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(FRAME_COLUMNS)
+                while True:
+                    rows = cursor.fetchmany()
+                    if not rows:
+                        break
+                    for (frames,) in rows:
+                        writer.writerows(unpack_frames(frames))
             
         logging.info(f"Exported trial {trial_number} to {csv_path}")
-        conn.close()
     except Exception as e:
         logging.error(f"Error exporting trial {trial_number} to CSV: {e}")
 
-def read_can_messages(trial_number, can_queue):
-    """Read CAN messages and store them in the database"""
-    global running
-    channel = 0
-    
-    # Wait for motor power
-    logging.info("Waiting for motor power...")
-    if not detect_power(channel):
-        logging.info("No motor power detected. Exiting.")
-        return
-
-    with canlib.openChannel(channel, canlib.canOPEN_ACCEPT_VIRTUAL) as ch:
-        ch.setBusOutputControl(canlib.canDRIVER_NORMAL)
-        ch.setBusParams(canlib.canBITRATE_100K)
-        ch.busOn()
-        
-        logging.info(f"Starting data collection for trial {trial_number}")
-        while running:
-            try:
-                msg = ch.read()
-                pdo_label = pdo_map.get(msg.id, "Unknown_PDO")
-                msg_data = format_can_message(msg)
-                can_queue.put(msg_data)
-                
-                if detect_power_off(channel):
-                    logging.info("Motor power off detected, ending trial")
+def init_csv_exporter():
+    """Ignore stop signals in the CSV export worker.
+    Ctrl-C and systemctl stop signal the whole process group, so the worker
+    would otherwise die mid-export; the collector decides when it stops."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def start_csv_exporter():
+    """Start the CSV export worker process.
+    It is spawned fresh rather than forked, so it inherits none of this
+    process's SQLite state."""
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_csv_exporter)
+
+def submit_csv_export(exporter, trial_number):
+    """Queue a trial's CSV export, replacing the worker if it has died.
+    Returns the exporter to use from now on and the export's future."""
+    try:
+        return exporter, exporter.submit(export_trial_to_csv, trial_number)
+    except BrokenProcessPool:
+        logging.error("CSV export worker died, starting a new one")
+        exporter.shutdown(wait=False)
+        exporter = start_csv_exporter()
+        return exporter, exporter.submit(export_trial_to_csv, trial_number)
+
+def check_csv_exports(exports):
+    """Log exports that failed and return the (trial_number, future) pairs still running"""
+    pending = []
+    for trial_number, future in exports:
+        if not future.done():
+            pending.append((trial_number, future))
+        elif future.exception() is not None:
+            logging.error(f"CSV export of trial {trial_number} failed: {future.exception()}")
+    return pending
+
+def db_writer(can_queue, trial_number):
+    """Write queued CAN messages to the trial table until a None sentinel arrives"""
+    done = False
+    conn = None
+    try:
+        conn = open_db(FRAMES_DATABASE, cache_size=WRITER_CACHE_SIZE)
+        create_table_for_trial(conn, trial_number)
+        while not done:
+            # Wake up when a full batch is queued or the interval expires
+            data_ready.wait(WRITE_INTERVAL)
+            data_ready.clear()
+
+            batch = []
+            while can_queue:
+                msg_data = can_queue.popleft()
+                if msg_data is None:
+                    done = True
                     break
-                    
-            except canlib.CanNoMsg:
-                pass
-            except KeyboardInterrupt:
-                break
-        ch.busOff()
+                batch.append(msg_data)
+
+            if batch:
+                conn.execute("BEGIN IMMEDIATE")
+                store_data_for_trial(batch, trial_number, conn)
+                conn.commit()
+    except Exception as e:
+        logging.error(f"Error writing trial {trial_number} to database: {e}")
+        # Keep consuming up to this trial's sentinel so the rest of it doesn't
+        # pile up in memory or end up in the next trial's table
+        while not done:
+            data_ready.wait(WRITE_INTERVAL)
+            data_ready.clear()
+            while can_queue:
+                if can_queue.popleft() is None:
+                    done = True
+                    break
+    finally:
+        if conn is not None:
+            conn.close()
+
+def queue_frames(frames):
+    """Queue a burst of frames, waking the writer once a full batch is waiting"""
+    can_queue.extend(frames)
+    if len(can_queue) >= WRITE_BATCH_SIZE:
+        data_ready.set()
 
 def main():
-    global running
-    
     def signal_handler(signum, frame):
-        global running
         print("\nStopping data collection...")
-        running = False
+        stop_event.set()
     
     # Set up signal handlers
     signal.signal(signal.SIGINT, signal_handler)
@@ -123,37 +186,41 @@ def main():
     # Create database directory if it doesn't exist
     os.makedirs(os.path.dirname(FRAMES_DATABASE), exist_ok=True)
     
-    while running:
+    # CSV exports run in a separate process so the next trial can start collecting
+    exporter = start_csv_exporter()
+    exports = []
+    
+    while not stop_event.is_set():
         try:
             # Get next trial number
             trial_number = get_next_trial_number()
             
-            # Create table for this trial
-            create_table_for_trial(trial_number)
-            
-            # Start data collection
-            read_can_messages(trial_number, can_queue)
-            
-            # Process collected data
-            batch = []
-            while not can_queue.empty():
-                msg_data = can_queue.get()
-                batch.append(msg_data)
-                if len(batch) >= 50:  # Process in batches of 50
-                    store_data_for_trial(batch, trial_number)
-                    batch = []
-            
-            # Store any remaining messages
-            if batch:
-                store_data_for_trial(batch, trial_number)
-            
-            # Export to CSV
-            export_trial_to_csv(trial_number)
+            # Start the database writer before collection begins
+            writer = threading.Thread(target=db_writer, args=(can_queue, trial_number))
+            writer.start()
+            try:
+                # Power detection and collection share one open channel
+                with open_channel(CHANNEL) as ch:
+                    read_can_messages(trial_number, queue_frames, ch)
+            finally:
+                # Tell the writer the trial is over and wait for it to flush
+                can_queue.append(None)
+                data_ready.set()
+                writer.join()
+
+            # Export to CSV without holding up the next trial
+            exports = check_csv_exports(exports)
+            exporter, future = submit_csv_export(exporter, trial_number)
+            exports.append((trial_number, future))
                 
         except Exception as e:
             logging.error(f"Error in main loop: {e}")
-            time.sleep(5)  # Wait before retrying
+            stop_event.wait(5)  # Wait before retrying, unless asked to stop
             continue
 
+    # Let any pending exports finish before exiting
+    exporter.shutdown(wait=True)
+    check_csv_exports(exports)
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,117 @@
+from canlib import canlib
+import struct
+import threading
+import logging
+from contextlib import contextmanager
+
+# Shared by the collectors. Logging goes through the root logger so each
+# collector's own logging setup applies; none is configured here.
+
+CHANNEL = 0  # Kvaser channel the motor controller is on
+stop_event = threading.Event()  # Set by the signal handler to stop collecting
+POWER_THRESHOLD = 100  # Adjust this threshold based on your motor's normal voltage
+POWER_OFF_THRESHOLD = 50  # Voltage below this indicates motor is off
+READ_TIMEOUT = 1000  # How long ch.read() blocks waiting for a frame (ms)
+VOLTAGE_OFFSET = 6  # DC Bus Voltage is the S16 in bytes 6-7 of frame 390
+_UNPACK_VBUS = struct.Struct('<h').unpack_from
+READ_BURST_SIZE = 64  # Most frames drained from the driver per queue push
+
+
+@contextmanager
+def open_channel(channel):
+    """Open a CAN channel and keep it bus on for the duration of the block"""
+    with canlib.openChannel(channel, canlib.canOPEN_ACCEPT_VIRTUAL) as ch:
+        ch.setBusOutputControl(canlib.canDRIVER_NORMAL)
+        ch.setBusParams(canlib.canBITRATE_100K)
+        ch.busOn()
+        try:
+            yield ch
+        finally:
+            ch.busOff()
+
+
+def _voltage_counter(predicate, required=3):
+    """Return a check that takes a frame 390 payload and returns its DC Bus
+    Voltage once predicate has held for `required` consecutive readings, else None"""
+    consecutive_readings = 0
+
+    def check(data):
+        nonlocal consecutive_readings
+        if len(data) < 8:
+            return None
+        voltage = _UNPACK_VBUS(data, VOLTAGE_OFFSET)[0]
+        logging.debug("Current voltage: %d", voltage)
+        if not predicate(voltage):
+            consecutive_readings = 0
+        else:
+            consecutive_readings += 1
+            if consecutive_readings >= required:
+                return voltage
+        return None
+
+    return check
+
+
+def detect_power(ch):
+    """Monitor DC Bus Voltage to detect when motor is powered"""
+    powered_on = _voltage_counter(lambda v: v > POWER_THRESHOLD)
+
+    while not stop_event.is_set():
+        try:
+            msg = ch.read(timeout=READ_TIMEOUT)
+            if msg.id == 390:  # Message ID for DC Bus Voltage
+                voltage = powered_on(msg.data)
+                if voltage is not None:
+                    logging.info(f"Motor power detected! Voltage: {voltage}")
+                    return True
+        except canlib.CanNoMsg:
+            continue
+        except KeyboardInterrupt:
+            break
+    return False
+
+
+def read_can_messages(trial_number, enqueue, ch):
+    """Read CAN messages until power off, passing each burst of
+    (timestamp, id, data) frames to enqueue"""
+    # Wait for motor power
+    logging.info("Waiting for motor power...")
+    if not detect_power(ch):
+        logging.info("No motor power detected. Exiting.")
+        return
+
+    logging.info(f"Starting data collection for trial {trial_number}")
+    # Bind the per-frame calls to locals once instead of looking them up per frame
+    read = ch.read
+    powered_off = _voltage_counter(lambda v: v < POWER_OFF_THRESHOLD)
+    while not stop_event.is_set():
+        frames = []
+        powered = True
+        try:
+            # Block for the first frame, then drain up to a burst of
+            # whatever else the driver has already buffered
+            msg = read(timeout=READ_TIMEOUT)
+            while True:
+                frames.append((msg.timestamp, msg.id, bytes(msg.data)))
+
+                # Watch the DC Bus Voltage on this channel to detect power off
+                if msg.id == 390:
+                    voltage = powered_off(msg.data)
+                    if voltage is not None:
+                        logging.info(f"Motor power off detected, ending trial. Voltage: {voltage}")
+                        powered = False
+                        break
+
+                if len(frames) >= READ_BURST_SIZE:
+                    break
+                msg = read()
+        except canlib.CanNoMsg:
+            pass  # The receive buffer is empty
+        except KeyboardInterrupt:
+            powered = False
+
+        # Queue the whole burst in one call
+        if frames:
+            enqueue(frames)
+        if not powered:
+            break
@@ -1,14 +1,75 @@
 import sqlite3
 import os
+import struct
+from contextlib import contextmanager
+from functools import lru_cache
 
 # Use a relative path for the database
 DATABASE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "frames_data.db")
 
 NAME = "frames_data.db"
 
+INSERT_SQL = 'INSERT INTO {} (base_timestamp, count, frames) VALUES (?, ?, ?)'
+
+# Frames are packed several to a row to cut per-row B-tree work on insert.
+# Each packed frame is timestamp, frame id, data length and up to 8 data bytes.
+FRAME_STRUCT = struct.Struct('<dIB8s')
+FRAMES_PER_ROW = 64
+FRAME_COLUMNS = ('timestamp', 'frame_id', 'data')
+
+
+def quote_identifier(name):
+    # Table names can't be bound as parameters, so quote them for SQL instead
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+@lru_cache(maxsize=None)
+def insert_statement(trial_number):
+    # Build each trial's INSERT text once. sqlite3 caches prepared statements
+    # per connection keyed by SQL text, so reusing the same string reuses the
+    # prepared statement instead of compiling it again for every batch.
+    return INSERT_SQL.format(quote_identifier(trial_number))
+
+
+# Page cache sizes in SQLite's negative-KiB form: the default for short-lived
+# connections, and a larger one for the collectors' long-running writers
+DEFAULT_CACHE_SIZE = -20000
+WRITER_CACHE_SIZE = -65536
+
+
+def open_db(database=DATABASE_NAME, mmap_size=0, cache_size=DEFAULT_CACHE_SIZE):
+    # Open a connection in WAL mode so the collector can keep writing while
+    # an exporter reads, and only fsync at checkpoints instead of every commit.
+    # A non-zero mmap_size lets read-heavy connections map the file instead of
+    # reading it a page at a time.
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size={int(cache_size)}")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    if mmap_size:
+        conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+    return conn
+
+
+# Bytes of the database file mapped by the export connections
+EXPORT_MMAP_SIZE = 256 * 1024 * 1024
+
+
+@contextmanager
+def export_connection(database=DATABASE_NAME):
+    # Open a memory-mapped connection for a single export and close it when
+    # the export is done, so no connection outlives the data it read
+    conn = open_db(database, mmap_size=EXPORT_MMAP_SIZE)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
 
 def get_next_trial_number():
-    with sqlite3.connect(DATABASE_NAME) as conn:
+    with open_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS meta (
@@ -26,33 +87,39 @@ def get_next_trial_number():
 
 def create_table_for_trial(conn, trial_number):
     # This function now creates a table specifically for a given trial number
-    # Each table will store data dictionaries as rows
+    # Each row packs up to FRAMES_PER_ROW raw CAN frames in arrival order
     cursor = conn.cursor()
     table_name = trial_number
     cursor.execute(f'''
-    CREATE TABLE IF NOT EXISTS {table_name} (
-        timestamp REAL PRIMARY KEY,
-        voltage REAL,
-        throttle_mv REAL,
-        throttle_percentage INTEGER,
-        RPM INTEGER,
-        torque REAL,
-        motor_temp REAL,
-        current REAL
+    CREATE TABLE IF NOT EXISTS {quote_identifier(table_name)} (
+        base_timestamp REAL,
+        count INTEGER,
+        frames BLOB
     )
     ''')
 
 
-def store_data_for_trial(data_dicts, trial_number):
-    with sqlite3.connect(DATABASE_NAME) as conn:
-        # Create a table for this specific trial
-        create_table_for_trial(conn, trial_number)
-        cursor = conn.cursor()
-        table_name = trial_number
-        for data_dict in data_dicts:
-            placeholders = ', '.join(['?'] * len(data_dict))
-            columns = ', '.join(data_dict.keys())
-            values = tuple(data_dict.values())
-            cursor.execute(
-                f'INSERT INTO {table_name} ({columns}) VALUES ({placeholders})', values)
-        conn.commit()
+def store_data_for_trial(rows, trial_number, conn=None):
+    # rows are a list of (timestamp, frame_id, data) tuples, packed
+    # FRAMES_PER_ROW at a time and inserted with one executemany.
+    # Without a connection this opens its own and commits the batch.
+    # Callers passing an open connection own the transaction around it.
+    if conn is None:
+        with open_db(cache_size=WRITER_CACHE_SIZE) as conn:
+            create_table_for_trial(conn, trial_number)
+            store_data_for_trial(rows, trial_number, conn)
+        return
+    pack = FRAME_STRUCT.pack
+    packed_rows = []
+    for start in range(0, len(rows), FRAMES_PER_ROW):
+        chunk = rows[start:start + FRAMES_PER_ROW]
+        frames = b''.join([pack(timestamp, frame_id, len(data), data)
+                           for timestamp, frame_id, data in chunk])
+        packed_rows.append((chunk[0][0], len(chunk), frames))
+    conn.executemany(insert_statement(trial_number), packed_rows)
+
+
+def unpack_frames(frames):
+    # Expand a packed frames blob back into (timestamp, frame_id, data) tuples
+    return [(timestamp, frame_id, data[:length])
+            for timestamp, frame_id, length, data in FRAME_STRUCT.iter_unpack(frames)]
@@ -1,8 +1,10 @@
 # Adjust this import based on your actual function
-from maps import format_can_message_csv
+from maps import decode_data, decode_frames, pdo_map, FRAME_STRUCTS, KNOWN_IDS
+from database_functions import open_db, export_connection, quote_identifier
 import sqlite3
 import csv
 from datetime import datetime
+from operator import itemgetter
 import os
 
 def get_database_path():
@@ -13,6 +15,8 @@ def get_database_path():
     return os.path.join(db_dir, f"boat_data_{date_str}.db")
 
 DATABASE_NAME = get_database_path()
+CSV_BUFFER_SIZE = 1024 * 1024  # Write CSV exports in 1 MiB chunks
+FETCH_SIZE = 10000  # Rows read from the database per fetch when exporting
 
 # Assuming value_range_map is defined as shown previously
 
@@ -37,9 +41,30 @@ value_range_map = {
     (1158, (6, 7)): ("S16", "Motor measurements: DC bus current", "-32768 to 32767", "Adc"),
 }
 
+# Decoded value columns in header order, built once instead of per row
+DESCRIPTIONS = tuple(dict.fromkeys(description for _, description, _, _ in value_range_map.values()))
+
+# Payload length that each batch-decodable COB-ID is decoded at
+FRAME_SIZES = {frame_id: frame_layout.size for frame_id, (frame_layout, _) in FRAME_STRUCTS.items()}
+
+def build_column_getters():
+    # Per COB-ID, pick a batch-decoded tuple's values into DESCRIPTIONS order.
+    # Columns the frame doesn't carry index the '' appended after its values.
+    getters = {}
+    for frame_id, (_, value_info) in FRAME_STRUCTS.items():
+        names = [description for description, _, _ in value_info]
+        getters[frame_id] = itemgetter(*[names.index(description) if description in names else len(names)
+                                         for description in DESCRIPTIONS])
+    return getters
+
+COLUMN_GETTERS = build_column_getters()
+
+# Value columns for frames with a COB-ID nothing decodes
+EMPTY_COLUMNS = ('',) * len(DESCRIPTIONS)
+
 def list_tables():
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = open_db(DATABASE_NAME)
         cursor = conn.cursor()
 
         # Query to get all table names
@@ -60,67 +85,63 @@ def list_tables():
 
 def export_trial_data_to_csv(trial_number):
     CSV_FILE_PATH = f"./csv_data/_data_{trial_number}.csv"
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    # Fetch all messages for the given trial number, sorted by timestamp
-    cursor.execute(
-        "SELECT * from 'trial_24'")
-    messages = cursor.fetchall()
-
-    conn.close()
+    with export_connection(DATABASE_NAME) as conn:
+        cursor = conn.cursor()
+        cursor.arraysize = FETCH_SIZE
+
+        # Prepare headers for CSV based on value_range_map
+        headers = ['Trial Number', 'Timestamp',
+                   'Message ID', 'PDO Label', 'DLC', 'Flags', *DESCRIPTIONS]
+
+        # Fetch all messages for the given trial number, sorted by timestamp
+        cursor.execute(
+            f"SELECT * from {quote_identifier(f'trial_{trial_number}')} ORDER BY timestamp")
+
+        # Open the CSV file and write the messages a chunk at a time
+        with open(CSV_FILE_PATH, mode='w', newline='', buffering=CSV_BUFFER_SIZE) as file:
+            writer = csv.writer(file)
+            writer.writerow(headers)
+
+            while True:
+                messages = cursor.fetchmany()
+                if not messages:
+                    break
+
+                # Decode all full-length payloads of each known COB-ID in one batch
+                batches = {}
+                for index, (_, _, frame_id, data) in enumerate(messages):
+                    if FRAME_SIZES.get(frame_id) == len(data):
+                        batches.setdefault(frame_id, []).append(index)
+
+                decoded_columns = [None] * len(messages)
+                for frame_id, indices in batches.items():
+                    get_columns = COLUMN_GETTERS[frame_id]
+                    values = decode_frames(frame_id, [messages[index][3] for index in indices])
+                    for index, frame_values in zip(indices, values):
+                        decoded_columns[index] = get_columns(frame_values + ('',))
+
+                for (trial_num, timestamp, frame_id, data), columns in zip(messages, decoded_columns):
+                    pdo_label = pdo_map.get(frame_id, "Unknown PDO")
+                    if columns is None and frame_id not in KNOWN_IDS:
+                        columns = EMPTY_COLUMNS
+                    elif columns is None:
+                        # Short frames go through the per-message decoder. Only the
+                        # decoded values are needed, not a full formatted message.
+                        data_values = decode_data(frame_id, data)
+                        columns = [data_values[description][0] if description in data_values else ''
+                                   for description in DESCRIPTIONS]
+
+                    # Build the row in header order, leaving values this frame lacks empty
+                    writer.writerow((
+                        trial_number,
+                        timestamp,
+                        frame_id,
+                        pdo_label,
+                        len(data),
+                        0,
+                        *columns,
+                    ))
 
-    # Prepare headers for CSV based on value_range_map
-    headers = ['Trial Number', 'Timestamp',
-               'Message ID', 'PDO Label', 'DLC', 'Flags']
-    for _, description, _, _ in value_range_map.values():
-        if description not in headers:
-            headers.append(description)
-
-    # Initialize a structure to hold decoded data by timestamp
-    decoded_data_by_timestamp = {}
-
-    for trial_num, timestamp, frame_id, data in messages:
-        # Decode each message
-        decoded_message = format_can_message_csv({
-            'id': frame_id,
-            'data': data,  # Ensure this data is in the correct format for your decoding function
-            'timestamp': timestamp,
-            'flags': 0,
-            'dlc': len(data)
-        })
-
-        # If the timestamp is not already a key in the dictionary, add it
-        if timestamp not in decoded_data_by_timestamp:
-            decoded_data_by_timestamp[timestamp] = []
-
-        # Append decoded data for this timestamp
-        decoded_data_by_timestamp[timestamp].append(decoded_message)
-
-    # Open the CSV file and start writing
-    with open(CSV_FILE_PATH, mode='w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=headers)
-        writer.writeheader()
-
-        for timestamp, messages in decoded_data_by_timestamp.items():
-            for message in messages:
-                row = {
-                    'Trial Number': trial_number,
-                    'Timestamp': timestamp,
-                    'Message ID': message['frame_id'],
-                    'PDO Label': message['pdo_label'],
-                    'DLC': message['dlc'],
-                    'Flags': message['flags']
-                }
-
-                # Add decoded data values to the row
-                for desc in value_range_map.values():
-                    if desc[1] in message['data_values']:
-                        row[desc[1]] = message['data_values'][desc[1]][0]
-                    else:
-                        row[desc[1]] = ''
-
-                writer.writerow(row)
 def export_sqlite_to_csv(table_name, output_csv):
     """
     Exports data from an SQLite database table to a CSV file.
@@ -130,29 +151,25 @@ def export_sqlite_to_csv(table_name, output_csv):
     :param output_csv: Path to the output CSV file.
     """
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        
-        # Fetch column names
-        cursor.execute(f"PRAGMA table_info({table_name})")
-        columns = [col[1] for col in cursor.fetchall()]
+        with export_connection(DATABASE_NAME) as conn:
+            cursor = conn.cursor()
+            table_name = quote_identifier(table_name)
         
-        # Fetch data from the table
-        cursor.execute(f"SELECT * FROM {table_name}")
-        rows = cursor.fetchall()
+            # Fetch column names
+            cursor.execute(f"PRAGMA table_info({table_name})")
+            columns = [col[1] for col in cursor.fetchall()]
         
-        # Write to CSV
-        with open(output_csv, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(columns)  # Write headers
-            writer.writerows(rows)  # Write data
+            # Stream data from the table to CSV; writerows pulls rows straight
+            # from the cursor, so no Python loop or row list is involved
+            cursor.execute(f"SELECT * FROM {table_name}")
+            with open(output_csv, 'w', newline='', buffering=CSV_BUFFER_SIZE) as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(columns)  # Write headers
+                writer.writerows(cursor)  # Write data
         
         print(f"Data exported successfully to {output_csv}")
     except sqlite3.Error as e:
         print(f"SQLite error: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 # Example usage
 db_path = "/mnt/data/frames_data.db"
@@ -167,7 +184,7 @@ export_sqlite_to_csv("trial_25", output_csv)
 
 def create_new_trial_table():
     """Creates a new table for the current trial with timestamp"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = open_db(DATABASE_NAME)
     cursor = conn.cursor()
     
     # Create table with timestamp in name
@@ -175,7 +192,7 @@ def create_new_trial_table():
     table_name = f"trial_{timestamp}"
     
     cursor.execute(f'''
-    CREATE TABLE IF NOT EXISTS {table_name} (
+    CREATE TABLE IF NOT EXISTS {quote_identifier(table_name)} (
         trial_number INTEGER,
         timestamp REAL,
         frame_id INTEGER,
@@ -183,6 +200,13 @@ def create_new_trial_table():
     )
     ''')
     
+    # Non-unique, since repeated PDOs can share a timestamp; lets the export's
+    # ORDER BY timestamp walk the index instead of sorting
+    cursor.execute(f'''
+    CREATE INDEX IF NOT EXISTS {quote_identifier(table_name + "_timestamp")}
+    ON {quote_identifier(table_name)} (timestamp)
+    ''')
+    
     conn.commit()
     conn.close()
     return table_name
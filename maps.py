@@ -1,4 +1,5 @@
 import struct
+from functools import lru_cache
 
 value_range_map = {
     # COB-ID, Bytes : (Data Type, Description, Value Range, Units)
@@ -48,57 +49,104 @@ pdo_map = {
     1158: "PDO4",
 }
 
-
-def decode_data(msg_id, data_bytes):
-    # print(f"Decoding data for msg_id: {msg_id} with data_bytes: {data_bytes}")
-    data_values = {}
-
-    for key, (data_type, description, value_range, units) in value_range_map.items():
-        cob_id, byte_indices = key
-
-        # Check if the msg_id matches the cob_id. If not, skip this iteration
-        if msg_id != cob_id:
-            continue
-
-        if isinstance(byte_indices, tuple):
-            start, end = key[1]
-            # print(f"For msg_id {msg_id}, data_bytes length: {len(data_bytes)}")
-            if end is None and start >= len(data_bytes):
-                # print("Index out of range for single-byte key:", key)
-                continue
-            elif end is not None and (start >= len(data_bytes) or end >= len(data_bytes)):
-                # print("Index out of range for multi-byte key:", key)
-                continue
+# COB-IDs that carry decodable fields, for an O(1) check before decoding
+KNOWN_IDS = frozenset(cob_id for cob_id, _ in value_range_map)
+
+# Struct format for each data type, with the byte order given explicitly.
+# CANopen PDO data is little-endian, which is also how the collectors read
+# the DC bus voltage from frame 390.
+FIELD_FORMATS = {"U16": "<H", "S16": "<h", "U8": "B"}
+
+
+def build_decoders():
+    # Per COB-ID, list each field as (description, value_range, units,
+    # compiled struct, byte offset) so decode_data never walks value_range_map
+    decoders = {}
+    for (cob_id, byte_indices), (data_type, description, value_range, units) in value_range_map.items():
+        field_format = FIELD_FORMATS.get(data_type)
+        if field_format is None:
+            continue  # Unsupported data type
+        offset = byte_indices[0] if isinstance(byte_indices, tuple) else byte_indices
+        decoders.setdefault(cob_id, []).append(
+            (description, value_range, units, struct.Struct(field_format), offset))
+    return decoders
+
+
+DECODERS = build_decoders()
+
+
+def build_frame_structs():
+    # Precompile, per COB-ID, one struct that unpacks every field of a
+    # full-length frame in a single call, plus the metadata for each value
+    frame_structs = {}
+    for cob_id, fields in DECODERS.items():
+        codes = []
+        position = 0
+        for _, _, _, field_struct, offset in fields:
+            if offset != position:
+                break  # Fields leave a gap; decode field by field
+            codes.append(field_struct.format[-1])
+            position += field_struct.size
         else:
-            start = key[1]
-            if start >= len(data_bytes):
-                continue  # Skip this iteration if index is out of range
-            end = start  # Use start index as end index for single-byte data
+            frame_structs[cob_id] = (
+                struct.Struct('<' + ''.join(codes)),
+                [(description, value_range, units) for description, value_range, units, _, _ in fields],
+            )
+    return frame_structs
 
-        if data_type == "U16":
-            value = (data_bytes[start] << 8) + data_bytes[end]
-            # print("value U16: ", value)
 
-        elif data_type == "S16":
-            value = struct.unpack('>h', bytes(data_bytes[start:end+1]))[0]
-            # print("value S16: ", value)
+FRAME_STRUCTS = build_frame_structs()
 
-        elif data_type == "U8":
-            value = data_bytes[start]
-            # print("value U8: ", value)
 
-        elif data_type == "0-15":
-            value = data_bytes[start] & 0x0F
-            # print("value 0-15: ", value)
-
-        else:
-            value = "Unsupported data type"
-            # print("unsupported: ", value)
-
-        data_values[description] = (value, value_range, units)
-        # print("data values: ", data_values)
-
-    return data_values
+def decode_data(msg_id, data_bytes):
+    if msg_id not in KNOWN_IDS:
+        return {}  # Nothing in value_range_map describes this frame
+    length = len(data_bytes)
+    frame_struct = FRAME_STRUCTS.get(msg_id)
+    if frame_struct is not None and length == frame_struct[0].size:
+        # Full-length frame: unpack all fields with its precompiled struct
+        frame_layout, value_info = frame_struct
+        return {description: (value, value_range, units)
+                for (description, value_range, units), value in zip(value_info, frame_layout.unpack(data_bytes))}
+
+    # Short frame: decode the fields it is long enough to contain
+    return {description: (field_struct.unpack_from(data_bytes, offset)[0], value_range, units)
+            for description, value_range, units, field_struct, offset in DECODERS.get(msg_id, ())
+            if offset + field_struct.size <= length}
+
+
+@lru_cache(maxsize=None)
+def build_frame_dtypes():
+    # Build, on first use, one numpy structured dtype per COB-ID in
+    # FRAME_STRUCTS so a batch of payloads decodes in a single np.frombuffer
+    # call. numpy is optional; without it this is empty and decode_frames
+    # falls back to the precompiled structs.
+    try:
+        import numpy as np
+    except ImportError:
+        return {}
+
+    frame_dtypes = {}
+    for cob_id, (frame_layout, _) in FRAME_STRUCTS.items():
+        fields = DECODERS[cob_id]
+        frame_dtypes[cob_id] = np.dtype({
+            'names': [description for description, _, _, _, _ in fields],
+            'formats': [field_struct.format for _, _, _, field_struct, _ in fields],
+            'offsets': [offset for _, _, _, _, offset in fields],
+            'itemsize': frame_layout.size,
+        })
+    return frame_dtypes
+
+
+def decode_frames(msg_id, payloads):
+    # Decode a batch of full-length payloads that share a COB-ID in FRAME_STRUCTS.
+    # Returns one tuple per payload, in the frame's value_range_map field order.
+    data = b''.join(payloads)
+    frame_dtype = build_frame_dtypes().get(msg_id)
+    if frame_dtype is None:
+        return list(FRAME_STRUCTS[msg_id][0].iter_unpack(data))
+    import numpy as np
+    return np.frombuffer(data, dtype=frame_dtype).tolist()
 
 
 def format_can_message(msg):